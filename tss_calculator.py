@@ -1,6 +1,12 @@
+import abc
 import argparse
+import array
+import concurrent.futures
 import fitdecode
+import functools
 import logging
+import math
+import numpy as np
 import os.path
 import json
 
@@ -9,16 +15,13 @@ source_filename = '2023-11-16-20-20-52.fit'
 
 
 class FitParser:
-    def __init__(self):
+    def __init__(self, power_stream):
         self._total_duration = 0
-        self._power_readings = list()
+        self._power_stream = power_stream
 
     def get_total_duration(self):
         return self._total_duration
 
-    def get_power_readings(self):
-        return self._power_readings
-
     def parse_file(self, filepath):
         with fitdecode.FitReader(filepath) as fit:
             for frame in fit:
@@ -38,7 +41,7 @@ class FitParser:
 
     def _parse_frame_record(self, frame):
         if frame.has_field('power'):
-            self._power_readings.append(frame.get_value('power'))
+            self._power_stream.push_one(frame.get_value('power'))
 
 
 class JsonParser:
@@ -47,23 +50,34 @@ class JsonParser:
     KEY_INTERVAL_REST_POWER_ZONE = "restPowerZone"
     KEY_INTERVAL_WORK_DURATION = "workDuration"
     KEY_INTERVAL_WORK_POWER_ZONE = "workPowerZone"
+    POWER_ZONES_TO_FTP_FACTOR = {
+        "S1": 0.5,
+        "S2": 0.61,
+        "S3": 0.88,
+        "SST": 0.91,
+        "S4": 0.98,
+        "S5": 1.13
+    }
 
     def __init__(self, ftp):
         self._total_duration = 0
-        self._power_readings = list()
+        self._segments = list()
         self._ftp = ftp
+        self._power_zones_to_power = {
+            power_zone: factor * ftp
+            for power_zone, factor in JsonParser.POWER_ZONES_TO_FTP_FACTOR.items()
+        }
 
     def get_total_duration(self):
         return self._total_duration
 
-    def get_power_readings(self):
-        return self._power_readings
+    def get_segments(self):
+        return self._segments
 
     def parse_file(self, filepath):
         with open(filepath) as json_file:
             json_content = json.load(json_file)
             for workout_block in json_content:
-                print(workout_block)
                 if not JsonParser._validate_workout_block(workout_block):
                     continue
                 self._parse_workout_block(workout_block)
@@ -133,12 +147,9 @@ class JsonParser:
             return
 
     def _parse_workout_block_steady(self, duration_in_minutes, power_zone):
-        duration_in_seconds = JsonParser._convert_minutes_to_seconds(duration_in_minutes)
-        self._total_duration += duration_in_seconds
-
-        target_power = self._find_power_at_power_zone(power_zone)
-        power_readings = self._generate_power_readings_steady(duration_in_seconds, target_power)
-        self._power_readings += power_readings
+        segment = self._generate_segment_steady(duration_in_minutes, power_zone)
+        self._segments.append(segment)
+        self._total_duration += segment[1]
 
     def _parse_workout_block_interval(self, workout_block):
         repeats = workout_block[JsonParser.KEY_INTERVAL_REPEATS]
@@ -147,85 +158,166 @@ class JsonParser:
         rest_duration_in_minutes = workout_block[JsonParser.KEY_INTERVAL_REST_DURATION]
         rest_power_zone = workout_block[JsonParser.KEY_INTERVAL_REST_POWER_ZONE]
 
-        for _ in range(repeats):
-            self._parse_workout_block_steady(work_duration_in_minutes, work_power_zone)
-            self._parse_workout_block_steady(rest_duration_in_minutes, rest_power_zone)
+        work_segment = self._generate_segment_steady(work_duration_in_minutes, work_power_zone)
+        rest_segment = self._generate_segment_steady(rest_duration_in_minutes, rest_power_zone)
+        self._segments += [work_segment, rest_segment] * repeats
+        self._total_duration += (work_segment[1] + rest_segment[1]) * repeats
 
     def _duration_is_valid(duration_in_minutes):
         return duration_in_minutes > 0 and duration_in_minutes < 400
 
     def _power_zone_is_valid(power_zone):
-        return power_zone in ("S1", "S2", "S3", "SST", "S4", "S5")
+        return power_zone in JsonParser.POWER_ZONES_TO_FTP_FACTOR
 
     def _find_power_at_power_zone(self, power_zone):
-        power_zones_to_power = {
-            "S1": 0.5,
-            "S2": 0.61,
-            "S3": 0.88,
-            "SST": 0.91,
-            "S4": 0.98,
-            "S5": 1.13
-        }
-
-        if power_zone not in power_zones_to_power:
+        if power_zone not in self._power_zones_to_power:
             logging.error("Power zone factor not found: {}".format(power_zone))
             return 0
-        return power_zones_to_power[power_zone] * self._ftp
+        return self._power_zones_to_power[power_zone]
 
     def _convert_minutes_to_seconds(minutes):
         return int(minutes * 60)
 
-    def _generate_power_readings_steady(self, duration_in_seconds, power):
-        return [power] * duration_in_seconds
+    def _generate_segment_steady(self, duration_in_minutes, power_zone):
+        duration_in_seconds = JsonParser._convert_minutes_to_seconds(duration_in_minutes)
+        target_power = self._find_power_at_power_zone(power_zone)
+        return target_power, duration_in_seconds
 
 
-class NormalizedPowerCalculator:
-    def __init__(self, input_data):
-        self._input_data = input_data
-        self._rolling_averages = list()
-        self._raised_to_4th_power = list()
-        self._raised_values_average = None
-        self._result = None
+def sum_rolling_averages_raised_to_4th_power(power_readings, window_size):
+    rolling_sum = 0.0
+    for index in range(window_size):
+        rolling_sum += power_readings[index]
 
-        self._process_data()
+    rolling_average = rolling_sum / window_size
+    squared = rolling_average * rolling_average
+    sum_of_4th_powers = squared * squared
 
-    def get_result(self):
-        return self._result
+    for index in range(window_size, power_readings.size):
+        rolling_sum += power_readings[index] - power_readings[index - window_size]
+        rolling_average = rolling_sum / window_size
+        squared = rolling_average * rolling_average
+        sum_of_4th_powers += squared * squared
 
-    def _process_data(self):
-        self._calculate_rolling_average()
-        self._raise_to_4th_power()
-        self._find_average_of_raised_values()
-        self._find_4th_root_of_average()
+    return sum_of_4th_powers
 
-    def _calculate_rolling_average(self):
-        index = 0
-        window_size = 30
-        round_number_of_digits = 2
 
-        while index <= len(self._input_data) - window_size:
-            window = self._input_data[index: index + window_size]
-            window_average = round(
-                sum(window) / window_size, round_number_of_digits)
-            self._rolling_averages.append(window_average)
-            index += 1
+@functools.lru_cache(maxsize=None)
+def get_compiled_kernel():
+    # Numba is imported and the kernel compiled (or loaded from the cache) on
+    # the first normalized power calculation, so runs that never get there,
+    # like --help or invalid arguments, do not pay for it.
+    from numba import njit
+    return njit(fastmath=True, cache=True)(sum_rolling_averages_raised_to_4th_power)
+
+
+class PowerStream(abc.ABC):
+    @abc.abstractmethod
+    def push_one(self, power):
+        pass
+
+    @abc.abstractmethod
+    def push_many(self, power_readings):
+        pass
 
-    def _raise_to_4th_power(self):
-        power_value = 4
+    @abc.abstractmethod
+    def push_constant(self, power, number_of_readings):
+        pass
 
-        for element in self._rolling_averages:
-            raised = pow(element, power_value)
-            self._raised_to_4th_power.append(raised)
 
-    def _find_average_of_raised_values(self):
-        self._raised_values_average = sum(
-            self._raised_to_4th_power) / len(self._raised_to_4th_power)
+class NormalizedPowerAccumulator(PowerStream):
+    WINDOW_SIZE = 30
+    FLUSH_SIZE = 4096
 
-    def _find_4th_root_of_average(self):
+    def __init__(self):
+        # Room for a full batch on top of the readings kept from the previous
+        # flush; the buffer is allocated once and never resized.
+        self._pending_readings = np.empty(
+            NormalizedPowerAccumulator.FLUSH_SIZE + NormalizedPowerAccumulator.WINDOW_SIZE - 1,
+            dtype=np.float32)
+        self._number_of_pending_readings = 0
+        self._sum_of_4th_powers = 0.0
+        self._number_of_averages = 0
+
+    def push_one(self, power):
+        self._pending_readings[self._number_of_pending_readings] = power
+        self._number_of_pending_readings += 1
+        if self._number_of_pending_readings == self._pending_readings.size:
+            self._flush()
+
+    def push_many(self, power_readings):
+        power_readings = np.asarray(power_readings)
+        while power_readings.size > 0:
+            start = self._number_of_pending_readings
+            chunk = power_readings[:self._pending_readings.size - start]
+            self._pending_readings[start:start + chunk.size] = chunk
+            self._number_of_pending_readings += chunk.size
+            power_readings = power_readings[chunk.size:]
+            if self._number_of_pending_readings == self._pending_readings.size:
+                self._flush()
+
+    def push_constant(self, power, number_of_readings):
+        # Once a whole window is filled with the same power, every following
+        # rolling average equals that power, so the rest of the run is added
+        # without pushing the readings.
+        # The power is rounded to float32 once, so the buffered readings and
+        # the closed form use the same value; the 4th power is still taken in
+        # float64, as in the kernel.
+        power = float(np.float32(power))
+        window_size = NormalizedPowerAccumulator.WINDOW_SIZE
+        self.push_many(np.full(min(number_of_readings, window_size), power, dtype=np.float32))
+
+        number_of_remaining_readings = number_of_readings - window_size
+        if number_of_remaining_readings > 0:
+            squared = power * power
+            self._sum_of_4th_powers += number_of_remaining_readings * squared * squared
+            self._number_of_averages += number_of_remaining_readings
+
+    def get_result(self):
+        self._flush()
         round_number_of_digits = 2
-        root_value = 0.25
-        self._result = round(self._raised_values_average **
-                             root_value, round_number_of_digits)
+        raised_values_average = self._sum_of_4th_powers / self._number_of_averages
+        return round(math.sqrt(math.sqrt(raised_values_average)), round_number_of_digits)
+
+    def _flush(self):
+        # The last (window size - 1) readings are kept, so rolling averages
+        # spanning two flushes are still accounted for.
+        window_size = NormalizedPowerAccumulator.WINDOW_SIZE
+        number_of_readings = self._number_of_pending_readings
+
+        if number_of_readings >= window_size:
+            self._process_readings(self._pending_readings[:number_of_readings])
+
+        number_of_kept_readings = min(number_of_readings, window_size - 1)
+        self._pending_readings[:number_of_kept_readings] = self._pending_readings[
+            number_of_readings - number_of_kept_readings:number_of_readings]
+        self._number_of_pending_readings = number_of_kept_readings
+
+    def _process_readings(self, power_readings):
+        window_size = NormalizedPowerAccumulator.WINDOW_SIZE
+        self._sum_of_4th_powers += get_compiled_kernel()(power_readings, window_size)
+        self._number_of_averages += power_readings.size - window_size + 1
+
+
+class PowerReadingsRecorder(PowerStream):
+    def __init__(self):
+        # Same float32 readings as NormalizedPowerAccumulator, so recording
+        # and streaming a reading give the same value.
+        self._power_readings = array.array('f')
+
+    def push_one(self, power):
+        self._power_readings.append(power)
+
+    def push_many(self, power_readings):
+        power_readings = np.ascontiguousarray(power_readings, dtype=np.float32)
+        self._power_readings.frombytes(memoryview(power_readings).cast('B'))
+
+    def push_constant(self, power, number_of_readings):
+        self.push_many(np.full(number_of_readings, power, dtype=np.float32))
+
+    def get_result(self):
+        # A copy, so the recorder's array is not locked against further pushes.
+        return np.frombuffer(self._power_readings, dtype=np.float32).copy()
 
 
 def find_intensity_factor(normalized_power, ftp):
@@ -239,40 +331,66 @@ def find_training_stres_score(duration, normalized_power, intensity_factor, ftp)
     return round((duration * normalized_power * intensity_factor) / (ftp * number_of_seconds_in_hour) * 100, round_number_of_digits)
 
 
+def parse_fit_file(fit_file, power_stream):
+    parser = FitParser(power_stream)
+    parser.parse_file(fit_file)
+    return parser.get_total_duration()
+
+
+def read_data_from_fit_file(fit_file):
+    power_recorder = PowerReadingsRecorder()
+    duration = parse_fit_file(fit_file, power_recorder)
+    return duration, power_recorder.get_result()
+
+
 def read_data_from_fit_files(fit_files):
-    parser = FitParser()
-    for file in fit_files:
-        parser.parse_file(file)
-    return parser.get_total_duration(), parser.get_power_readings()
+    # Normalized power is not additive, so the readings of all files are
+    # pushed, in order, into a single accumulator.
+    power_accumulator = NormalizedPowerAccumulator()
+    if len(fit_files) == 1:
+        duration = parse_fit_file(fit_files[0], power_accumulator)
+        return duration, power_accumulator.get_result()
+
+    # Trade-off: parsing in parallel means every worker records the whole
+    # file and sends its readings back, so unlike the single-file path,
+    # memory is not constant but grows with the size of the files in flight.
+    total_duration = 0
+    max_workers = min(len(fit_files), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for duration, power_readings in executor.map(read_data_from_fit_file, fit_files):
+            total_duration += duration
+            power_accumulator.push_many(power_readings)
+    return total_duration, power_accumulator.get_result()
 
 
 def read_data_from_json_files(json_files, ftp):
     parser = JsonParser(ftp)
     for file in json_files:
         parser.parse_file(file)
-    return parser.get_total_duration(), parser.get_power_readings()
+
+    power_accumulator = NormalizedPowerAccumulator()
+    for power, duration_in_seconds in parser.get_segments():
+        power_accumulator.push_constant(power, duration_in_seconds)
+    return parser.get_total_duration(), power_accumulator.get_result()
 
 
-def calculate_tss(ftp, duration, power_readings):
-    normalized_power = NormalizedPowerCalculator(power_readings).get_result()
+def calculate_tss(ftp, duration, normalized_power):
     intensity_factor = find_intensity_factor(normalized_power, ftp)
     training_stress_score = find_training_stres_score(
         duration, normalized_power, intensity_factor, ftp)
 
     table = [
-        ["FTP", "{} W".format(ftp)],
-        ["Total workout duration", "{:.0f} min".format(duration / 60)],
-        ["{}".format('-' * 25), "{}".format('-' * 10)],
-        ["Normalized Power", "{:.0f} W".format(normalized_power)],
+        ["FTP", f"{ftp} W"],
+        ["Total workout duration", f"{duration / 60:.0f} min"],
+        ['-' * 25, '-' * 10],
+        ["Normalized Power", f"{normalized_power:.0f} W"],
         ["Intensity Factor", intensity_factor],
         ["Training Stress Score", training_stress_score]
     ]
 
     horizontal_line = '-' * 42
-    print(horizontal_line)
-    for row in table:
-        print("| {:25} | {:^10} |".format(*row))
-    print(horizontal_line)
+    table_lines = [f"| {name:25} | {value:^10} |" for name, value in table]
+    print("\n".join([horizontal_line, *table_lines, horizontal_line]))
 
 
 def parse_input_arguments():
@@ -283,6 +401,31 @@ def parse_input_arguments():
     return args
 
 
+def find_existing_files(files):
+    # A directory holding several of the files is listed once instead of
+    # checking every file separately.
+    files_by_directory = dict()
+    for file in files:
+        files_by_directory.setdefault(os.path.dirname(file), list()).append(file)
+
+    # The listing is only a fast path: any name it does not confirm (e.g. a
+    # different case on a case-insensitive filesystem, or an unreadable
+    # directory) is still checked with os.path.isfile().
+    existing_files = set()
+    for directory, directory_files in files_by_directory.items():
+        file_names = set()
+        if len(directory_files) > 1:
+            try:
+                with os.scandir(directory or os.curdir) as entries:
+                    file_names = {entry.name for entry in entries if entry.is_file()}
+            except OSError:
+                pass
+        existing_files.update(
+            file for file in directory_files
+            if os.path.basename(file) in file_names or os.path.isfile(file))
+    return existing_files
+
+
 def input_arguments_are_valid(arguments):
     valid_ftp_min = 100
     valid_ftp_max = 400
@@ -295,9 +438,10 @@ def input_arguments_are_valid(arguments):
             arguments.ftp, valid_ftp_min, valid_ftp_max))
         return False
 
+    existing_files = find_existing_files(arguments.data[0])
     for file in arguments.data[0]:
         current_file_type = None
-        if not os.path.isfile(file):
+        if file not in existing_files:
             logging.error("File does not exist: {}".format(file))
             return False
         if file.endswith(file_type_fit):
@@ -327,16 +471,16 @@ if __name__ == "__main__":
         exit()
 
     duration = None
-    power_readings = None
+    normalized_power = None
 
     first_file = input_arguments.data[0][0]
     if first_file.endswith('.fit'):
-        duration, power_readings = read_data_from_fit_files(
+        duration, normalized_power = read_data_from_fit_files(
             input_arguments.data[0])
     elif first_file.endswith('.json'):
-        duration, power_readings = read_data_from_json_files(
+        duration, normalized_power = read_data_from_json_files(
             input_arguments.data[0], input_arguments.ftp)
     else:
         logging.error("File extension not supported: {}".format(first_file))
 
-    calculate_tss(input_arguments.ftp, duration, power_readings)
+    calculate_tss(input_arguments.ftp, duration, normalized_power)